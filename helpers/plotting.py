@@ -36,15 +36,16 @@ def thumbnails(images, n_cols=None):
     images_y = int(np.ceil(n_images / images_x))
     size = (images_y, images_x)
         
-    # Allocate space for the thumbnails
-    output = np.zeros((size[0] * img_size[0], size[1] * img_size[1], img_size[2]))
+    # Allocate space for the thumbnails (integer images, e.g., uint8, are tiled without conversion to float)
+    dtype = images[0].dtype if np.issubdtype(images[0].dtype, np.integer) else np.float64
+    output = np.zeros((size[0] * img_size[0], size[1] * img_size[1], img_size[2]), dtype=dtype)
         
     for r in range(n_images):
         bx = int(r % images_x)
         by = int(np.floor(r / images_x))
         current = images[r].squeeze()
         if current.shape[0] != img_size[0] or current.shape[1] != img_size[1]:
-            current = resize(current, img_size[:-1], anti_aliasing=True)
+            current = resize(current, img_size[:-1], anti_aliasing=True, preserve_range=True)
         if len(current.shape) == 2:
             current = np.expand_dims(current, axis=2)
         output[by*img_size[0]:(by+1)*img_size[0], bx*img_size[1]:(bx+1)*img_size[1], :] = current
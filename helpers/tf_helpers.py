@@ -36,6 +36,20 @@ def manipulation_gamma(x, strength=2.0):
         return tf.pow(tf.clip_by_value(im_gamma, 1, 255) / 255.0, 1/strength, name='sqrt')
 
 
+def batch_gamma(x, low=0.25, high=3):
+    """ Random gamma correction of a batch of images - TF counterpart of helpers.utils.batch_gamma """
+    with tf.name_scope('batch_gamma'):
+        gamma = tf.random_uniform((tf.shape(x)[0], 1, 1, 1), minval=low, maxval=high)
+        return tf.clip_by_value(tf.pow(x, 1 / gamma), 0, 1)
+
+
+def batch_flip(x, prob=0.5, axis=2):
+    """ Randomly flip individual images in a batch (axis=2 - horizontal flips, axis=1 - vertical flips) """
+    with tf.name_scope('batch_flip'):
+        flip = tf.random_uniform((tf.shape(x)[0],)) < prob
+        return tf.where(flip, tf.reverse(x, axis=[axis]), x)
+
+
 def manipulation_median(x, kernel=3):
     kernel = int(kernel)
     with tf.name_scope('median_filter'):
@@ -306,3 +320,25 @@ def entropy(values, codebook, v=50, gamma=25):
     entropy = tf.cast(entropy, tf.float32)
 
     return entropy, histogram, weights
+
+
+def hard_entropy(values, codebook):
+    """ Entropy of hard-quantized values (counts of the nearest codebook entries) - TF counterpart of helpers.utils.entropy """
+
+    assert (codebook.shape[0] == 1)
+    assert (codebook.shape[1] > 1)
+
+    values = tf.reshape(values, (-1, 1))
+
+    # Drop values beyond the outer bin edges (+/- twice the largest codebook magnitude - see helpers.utils.bin_egdes)
+    max_value = 2 * tf.reduce_max(tf.abs(codebook))
+    values = tf.boolean_mask(values, tf.abs(values[:, 0]) <= max_value)
+
+    # Assign values to quantization bins (separated half-way between the codebook entries)
+    bin_edges = (codebook[:, 1:] + codebook[:, :-1]) / 2
+    indices = tf.reduce_sum(tf.cast(values >= bin_edges, tf.int32), axis=1)
+
+    counts = tf.unsorted_segment_sum(tf.ones_like(indices), indices, int(codebook.shape[1]))
+    counts = tf.cast(tf.maximum(counts, 1), tf.float32)
+    probs = counts / tf.reduce_sum(counts)
+    return - tf.reduce_sum(probs * tf.log(probs)) / 0.6931  # 0.6931 - log(2)
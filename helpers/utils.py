@@ -318,8 +318,25 @@ def is_nan(value):
 
 
 def qhist(values, code_book, density=False):
+    """
+    Histogram of values quantized to the nearest code book entries. Equivalent to np.histogram with code book bin
+    edges, but counts are accumulated directly with np.bincount (the values do not need to be sorted).
+    """
     code_book_edges = bin_egdes(code_book)
-    return np.histogram(values.reshape((-1, )), bins=code_book_edges, density=density)[0]
+    n_bins = len(code_book_edges) - 1
+    values = np.asarray(values).reshape((-1, ))
+
+    # The right-most edge is inclusive (consistent with np.histogram)
+    indices = np.searchsorted(code_book_edges, values, side='right') - 1
+    indices[values == code_book_edges[-1]] = n_bins - 1
+    indices = indices[(indices >= 0) & (indices < n_bins)]
+
+    counts = np.bincount(indices, minlength=n_bins)
+
+    if density:
+        return counts / counts.sum() / np.diff(code_book_edges)
+
+    return counts
 
 
 def entropy(batch_z, code_book):
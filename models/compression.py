@@ -24,6 +24,8 @@ class DCN(TFModel):
       weights              - soft quantization weights (TF)
       histogram            - latent space histogram based on soft quantization (TF)
       entropy              - entropy estimation (TF)
+      loss_eval            - L2 norm of the reconstruction error (TF, for validation)
+      entropy_eval         - entropy of the quantized latent representation (TF, for validation)
 
     # Attributes that need to be set-up by the derived classes:
       y
@@ -37,13 +39,15 @@ class DCN(TFModel):
     latent_post attributes.
     """
 
-    def __init__(self, sess, graph, label=None, x=None, nip_input=None, patch_size=128, latent_bpf=4, train_codebook=False, entropy_weight=None, default_val_is_train=True, scale_latent=False, use_batchnorm=False, use_gdn=False, verbose=False, loss_metric='L2', **kwargs):
+    def __init__(self, sess, graph, label=None, x=None, nip_input=None, patch_size=128, latent_bpf=4, train_codebook=False, entropy_weight=None, default_val_is_train=True, scale_latent=False, use_batchnorm=False, use_gdn=False, verbose=False, loss_metric='L2', staged_input=False, staging_device='/gpu:0', **kwargs):
         """
         Creates a forensic analysis network.
 
         :param sess: TF session or None (creates a new one)
         :param graph: TF graph or None (creates a new one)
         :param label: a suffix for the name scope of the model
+        :param staged_input: stage training batches on the device if no batch is fed (see stage_input; training only)
+        :param staging_device: device for staged input batches (e.g., '/gpu:0' or '/cpu:0')
         """
         super().__init__(sess, graph, label)
 
@@ -66,15 +70,27 @@ class DCN(TFModel):
         self.use_batchnorm = use_batchnorm
         self.use_gdn = use_gdn
         self.loss_metric = loss_metric
+        self.staged_input = staged_input
+        self._stage_op = None
 
         with self.graph.as_default():
             # Setup inputs:
             # - if possible take external tensor as input, otherwise create a placeholder
             # - if external input is given (from a NIP model), remember the input to the NIP model to facilitate 
             #   convenient operation of the class (see helper methods 'process*')
-            if x is None:
+            # - with staged input, the placeholder takes batches staged on the device if no batch is fed (see stage_input)
+            if x is None and staged_input:
+                self._staging_device = staging_device
+                with tf.device(self._staging_device):
+                    self._input_area = tf.contrib.staging.StagingArea(dtypes=[tf.float32], shapes=[(None, patch_size, patch_size, 3)], capacity=1)
+                    x_staged = self._input_area.get()
+                x = tf.placeholder_with_default(x_staged, shape=(None, patch_size, patch_size, 3), name='x_{}'.format(self.scoped_name))
+                self.use_nip_input = False
+            elif x is None:
                 x = tf.placeholder(tf.float32, shape=(None, patch_size, patch_size, 3), name='x_{}'.format(self.scoped_name))
                 self.use_nip_input = False
+            elif staged_input:
+                raise ValueError('Input staging is not available for models with external inputs!')
             else:
                 self.use_nip_input = True
             
@@ -101,6 +117,7 @@ class DCN(TFModel):
                     self._codebook = bin_centers
             
             # Construct the actual model -------------------------------------------------------------------------------
+            self._diagnostics = {}  # Tensors used for diagnostics of the latent space (see self.diagnostics)
             self.construct_model(kwargs)
             
             # Overwrite the output to guarantee correct data range and maintain gradient propagation
@@ -132,6 +149,11 @@ class DCN(TFModel):
                 loss_entropy_label = '+ {:.2f} * entropy'.format(self.entropy_weight) if self.entropy_weight is not None else ''
                 self.log('Initializing loss: {} {}'.format(self.loss_metric, loss_entropy_label))
                 
+                # Validation metrics: L2 norm of the reconstruction error, SSIM & entropy of the quantized latent
+                with tf.name_scope('evaluation'):
+                    self.loss_eval = tf.norm(self.x - self.y)
+                    self.entropy_eval = tf_helpers.hard_entropy(self.latent_post, self._codebook)
+
                 # Optimization
                 update_ops = tf.get_collection(tf.GraphKeys.UPDATE_OPS)
                 with tf.control_dependencies(update_ops):
@@ -171,10 +193,14 @@ class DCN(TFModel):
 
         # If requested, add batch norm to normalize the latent representation
         if self.use_batchnorm:
+            self.pre_bn = latent
             self.is_training = tf.placeholder(tf.bool, shape=(), name='{}/is_training'.format(self.scoped_name))
             latent = tf.contrib.layers.batch_norm(latent, scale=False, is_training=self.is_training,
                                                   scope='{}/encoder/bn_{}'.format(self.scoped_name, 0))
             self.log('batch norm: {}'.format(latent.shape))
+            self._diagnostics['pre_bn'] = self.pre_bn
+            for stat in ['moving_mean', 'moving_variance']:
+                self._diagnostics[stat] = self.graph.get_tensor_by_name('{}/encoder/bn_0/{}:0'.format(self.scoped_name, stat))
 
         # Learn a scaling factor for the latent features to encourage greater values (facilitates quantization)
         if self.scale_latent:
@@ -182,6 +208,7 @@ class DCN(TFModel):
             alphas = tf.get_variable('{}/encoder/latent_scaling'.format(self.scoped_name), shape=(), dtype=tf.float32, initializer=tf.constant_initializer(scaling_factor))
             latent = tf.multiply(alphas, latent, name='{}/encoder/latent_scaled'.format(self.scoped_name))
             self.log('scaling latent representation - init:{}'.format(scaling_factor))
+            self._diagnostics['scaling'] = alphas
 
         # Add identity to facilitate better display in the TF graph
         latent = tf.identity(latent, name='{}/latent'.format(self.scoped_name))
@@ -303,28 +330,111 @@ class DCN(TFModel):
             y = self.sess.run(self.y, feed_dict)
             return y.clip(0, 1)
 
+    def stage_input(self, batch_x):
+        """
+        Set up double-buffered input staging: batches from the given tensor (e.g., a tf.data iterator) are copied to
+        the device while the previous batch is being processed. Staged batches are used by training_step and
+        diagnostics when called without a batch. Can be set up only once per model (the first batch is staged eagerly).
+        :param batch_x: input tensor (N, H, W, 3:rgb) - usually the output of a tf.data iterator
+        """
+        if not self.staged_input:
+            raise ValueError('Input staging has not been enabled for this model (see the staged_input flag)!')
+
+        if self._stage_op is not None:
+            raise ValueError('Input staging has already been set up for this model!')
+
+        with self.graph.as_default():
+            with tf.device(self._staging_device):
+                self._stage_op = self._input_area.put([batch_x])
+            self.sess.run(self._stage_op)
+
     def training_step(self, batch_x, learning_rate, dropout_keep_prob=1.0):
         """
         Make a single training step and return current loss. Only the FAN model is updated.
+        :param batch_x: Input tensor (N, H, W, 3:rgb) or None to use the next staged batch (see stage_input)
         """
         with self.graph.as_default():
             feed_dict = {
-                    self.x if not self.use_nip_input else self.nip_input: batch_x,
                     self.lr: learning_rate
             }
+            fetches = [self.opt, self.loss, self.ssim, self.entropy]
+
+            if batch_x is not None:
+                feed_dict[self.x if not self.use_nip_input else self.nip_input] = batch_x
+            else:
+                fetches.append(self._staged_input_op())
+
             if hasattr(self, 'dropout'):
                 feed_dict[self.dropout] = dropout_keep_prob
                 
             if hasattr(self, 'is_training'):
                 feed_dict[self.is_training] = True                
             
-            _, loss, ssim, entropy = self.sess.run([self.opt, self.loss, self.ssim, self.entropy], feed_dict)
+            _, loss, ssim, entropy = self.sess.run(fetches, feed_dict)[:4]
             return {
                 'loss': np.sqrt(2 * loss),  # The L2 loss in TF is computed differently (half of non-square rooted norm)
                 'ssim': ssim,
                 'entropy': entropy
             }
 
+    def evaluate(self, batch_x, is_training=None, with_outputs=False):
+        """
+        Compute validation metrics (loss, SSIM and entropy of the quantized latent representation) in a single run.
+        :param batch_x: Input tensor (N, H, W, 3:rgb) or (N, H, W, 4:rggb) for RAW data chained through a NIP
+        :param is_training: can be used to override the default 'is_training' flag (may be useful for models with BN)
+        :param with_outputs: include the quantized latent representation ('z') and the decompressed images ('y')
+        """
+        with self.graph.as_default():
+            feed_dict = {
+                self.x if not self.use_nip_input else self.nip_input: batch_x
+            }
+            if hasattr(self, 'dropout'):
+                feed_dict[self.dropout] = 1.0
+
+            if hasattr(self, 'is_training'):
+                feed_dict[self.is_training] = is_training if is_training is not None else self.default_val_is_train
+
+            fetches = {'loss': self.loss_eval, 'ssim': self.ssim, 'entropy': self.entropy_eval}
+            if with_outputs:
+                fetches.update({'z': self.latent_post, 'y': self.y})
+
+            values = self.sess.run(fetches, feed_dict)
+            if with_outputs:
+                values['y'] = values['y'].clip(0, 1)
+            return values
+
+    def diagnostics(self, batch_x=None):
+        """
+        Fetch diagnostic stats of the latent space in a single run. Depending on the model, the returned dict contains:
+        - scaling                         - the latent scaling factor
+        - pre_bn                          - latent representation of the batch before batch norm
+        - moving_mean, moving_variance    - population statistics of the batch norm layer
+        :param batch_x: Input tensor (N, H, W, 3:rgb) or (N, H, W, 4:rggb) for RAW data chained through a NIP;
+                        None to use the next staged batch (see stage_input)
+        """
+        if len(self._diagnostics) == 0:
+            return {}
+
+        with self.graph.as_default():
+            fetches = dict(self._diagnostics)
+
+            # Only the batch statistics depend on the input - other diagnostics do not consume a (staged) batch
+            if batch_x is not None:
+                feed_dict = {self.x if not self.use_nip_input else self.nip_input: batch_x}
+            else:
+                feed_dict = {}
+                if 'pre_bn' in fetches:
+                    fetches['_stage'] = self._staged_input_op()
+
+            values = self.sess.run(fetches, feed_dict)
+            values.pop('_stage', None)
+            return values
+
+    def _staged_input_op(self):
+        if self._stage_op is None:
+            raise ValueError('No input batch given and input staging has not been set up (see stage_input)!')
+        return self._stage_op
+
     def compression_stats(self, patch_size=None, n_latent_bytes=None):
         """
         Get expected compression stats for the model:
@@ -152,6 +152,9 @@ def main():
 
     print('\n# Training:\n')
 
+    # Training batches are staged on the GPU (if available) ahead of the training steps
+    staging_device = '/gpu:0' if tf.test.is_gpu_available() else '/cpu:0'
+
     for counter, (index, params) in enumerate(parameters.drop(columns=['scenario', 'label']).iterrows()):
 
         print('## Scenario {} - {} / {}'.format(index, counter + 1, len(parameters)))
@@ -162,7 +165,7 @@ def main():
         # Create a DCN according to the spec
         dcn_params = {k: v for k, v in params.to_dict().items() if not utils.is_nan(v)}
         dcn_params['default_val_is_train'] = training_spec['validation_is_training']
-        dcn = getattr(compression, args.dcn)(sess, graph, None, patch_size=training_spec['patch_size'], **dcn_params)
+        dcn = getattr(compression, args.dcn)(sess, graph, None, patch_size=training_spec['patch_size'], staged_input=True, staging_device=staging_device, **dcn_params)
 
         model_code = dcn.model_code
 
@@ -5,17 +5,15 @@ import imageio
 import numpy as np
 import tensorflow as tf
 
-from collections import deque
-from skimage.transform import resize, rescale
-from skimage.measure import compare_ssim as ssim
+from concurrent.futures import ThreadPoolExecutor
 
 import matplotlib.pyplot as plt
 
 # Own libraries and modules
-from helpers import plotting, summaries, utils
+from helpers import plotting, summaries, tf_helpers, utils
 
 
-def visualize_distribution(dcn, data, ax=None, title=None):
+def visualize_distribution(dcn, data, ax=None, title=None, codebook=None):
 
     title = '' if title is None else title+' '
 
@@ -29,8 +27,8 @@ def visualize_distribution(dcn, data, ax=None, title=None):
     batch_z = dcn.compress(batch_x)
     batch_z = batch_z.reshape((-1,)).T
 
-    # Get current version of the quantization codebook
-    codebook = dcn.get_codebook().tolist()
+    # Get current version of the quantization codebook (unless provided)
+    codebook = np.asarray(dcn.get_codebook() if codebook is None else codebook, dtype=np.float32)
 
     # Find x limits for plotting
     if dcn._h.rounding == 'identity':
@@ -51,12 +49,15 @@ def visualize_distribution(dcn, data, ax=None, title=None):
 
     # Create a dense version of the quantization bins
     bin_centers = np.arange(qmin - 1, qmax + 1, 0.1)
-    bin_boundaries = np.convolve(bin_centers, [0.5, 0.5], mode='valid')
-    bin_centers = bin_centers[1:-1]
+    n_bins = len(bin_centers)
 
-    # Compute empirical histogram based on latent representation
-    hist = np.histogram(batch_z, bins=bin_boundaries, density=True)[0]
+    # Compute empirical histogram based on latent representation - count values by the index of the nearest bin center
+    # (the outer-most bins are only used to catch boundary values and are not displayed)
+    indices = np.rint((batch_z - bin_centers[0]) * 10).astype(np.int32)
+    indices = indices[(indices >= 1) & (indices < n_bins - 1)]
+    hist = np.bincount(indices, minlength=n_bins)[1:-1].astype(np.float64)
     hist = hist / hist.max()
+    bin_centers = bin_centers[1:-1]
 
     entropy = utils.entropy(batch_z, codebook)
 
@@ -77,12 +78,12 @@ def visualize_distribution(dcn, data, ax=None, title=None):
     return ax.figure
 
 
-def visualize_codebook(dcn):
+def visualize_codebook(dcn, codebook=None):
     qmin = -2 ** (dcn.latent_bpf - 1) + 1
     qmax = 2 ** (dcn.latent_bpf - 1)
 
     uniform_cbook = np.arange(qmin, qmax + 1)
-    codebook = dcn.get_codebook().tolist()
+    codebook = np.asarray(dcn.get_codebook() if codebook is None else codebook, dtype=np.float32)
 
     fig = plt.figure(figsize=(10, 1))
 
@@ -100,7 +101,7 @@ def visualize_codebook(dcn):
     return fig
 
 
-def save_progress(dcn, data, training, out_dir):
+def save_progress(dcn, data, training, out_dir, codebook=None):
     filename = os.path.join(out_dir, 'progress.json')
 
     output_stats = {
@@ -109,7 +110,7 @@ def save_progress(dcn, data, training, out_dir):
         'dcn': {
             'model': type(dcn).__name__,
             'args': dcn.get_parameters(),
-            'codebook': dcn.get_codebook().tolist()
+            'codebook': (dcn.get_codebook() if codebook is None else codebook).tolist()
         },
         'performance': dcn.performance,
     }
@@ -118,6 +119,69 @@ def save_progress(dcn, data, training, out_dir):
         json.dump(output_stats, f, indent=4)
 
 
+def compile_augmenter(probs, patch_size):
+    """
+    Build a data augmentation function (TF) specialized for the given augmentation probabilities: disabled operations
+    (probability 0) are skipped entirely, and operations with probability 1 are applied unconditionally.
+    """
+
+    def resize(batch_x):
+        # If rescaling needed, apply (area interpolation averages source pixels, i.e., down-sampling is anti-aliased)
+        return tf.cond(tf.equal(tf.shape(batch_x)[1], patch_size), lambda: batch_x,
+                       lambda: tf.image.resize_images(batch_x, [patch_size, patch_size], method=tf.image.ResizeMethod.AREA))
+
+    def flip(prob, axis):
+        if prob >= 1:
+            return lambda batch_x: tf.reverse(batch_x, axis=[axis])
+        return lambda batch_x: tf_helpers.batch_flip(batch_x, prob, axis=axis)
+
+    def gamma(prob):
+        if prob >= 1:
+            return tf_helpers.batch_gamma
+        return lambda batch_x: tf.cond(tf.random_uniform(()) < prob, lambda: tf_helpers.batch_gamma(batch_x), lambda: batch_x)
+
+    # Data augmentation - resizing, random horizontal / vertical flips (per image) and gamma correction
+    operations = []
+    if probs['resize'] > 0: operations.append(resize)
+    if probs['flip_h'] > 0: operations.append(flip(probs['flip_h'], 2))
+    if probs['flip_v'] > 0: operations.append(flip(probs['flip_v'], 1))
+    if probs['gamma'] > 0: operations.append(gamma(probs['gamma']))
+
+    def augment(batch_x):
+        for operation in operations:
+            batch_x = operation(batch_x)
+
+        batch_x.set_shape((None, patch_size, patch_size, 3))
+        return batch_x
+
+    return augment
+
+
+def training_batches(data, training, n_batches):
+    """
+    Create an (infinite) tf.data pipeline of augmented training batches. Batches are sampled from the dataset in a
+    background thread and augmented in the TF graph (resizing, flipping, gamma), so that data preparation overlaps
+    with the training steps. Needs to be called within the graph of the trained model.
+    """
+
+    patch_size = training['patch_size']
+    probs = training['augmentation_probs']
+
+    def sample_patch_size():
+        # Pick random patch size - will be resized later for augmentation
+        return np.random.choice(np.arange(patch_size, 2 * patch_size)) if np.random.uniform() < probs['resize'] else patch_size
+
+    def sample_batches():
+        next_patch_size = sample_patch_size if probs['resize'] > 0 else lambda: patch_size
+        while True:
+            for batch_id in range(n_batches):
+                yield data.next_training_batch(batch_id, training['batch_size'], next_patch_size())
+
+    dataset = tf.data.Dataset.from_generator(sample_batches, output_types=tf.float32, output_shapes=(None, None, None, 3))
+    dataset = dataset.map(compile_augmenter(probs, patch_size), num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    return dataset.prefetch(tf.data.experimental.AUTOTUNE)
+
+
 def train_dcn(tf_ops, training, data, directory='./data/models/dcn/playground/', overwrite=False):
     """
     tf_ops = {
@@ -146,12 +210,14 @@ def train_dcn(tf_ops, training, data, directory='./data/models/dcn/playground/',
     perf = dcn.performance
 
     caches = {
-        'loss': {'training': deque(maxlen=n_batches), 'validation': deque(maxlen=v_batches)},
-        'entropy': {'training': deque(maxlen=n_batches), 'validation': deque(maxlen=v_batches)},
-        'ssim': {'training': deque(maxlen=n_batches), 'validation': deque(maxlen=v_batches)}
+        'loss': {'training': np.empty(n_batches, dtype=np.float32), 'validation': np.empty(v_batches, dtype=np.float32)},
+        'entropy': {'training': np.empty(n_batches, dtype=np.float32), 'validation': np.empty(v_batches, dtype=np.float32)},
+        'ssim': {'training': np.empty(n_batches, dtype=np.float32), 'validation': np.empty(v_batches, dtype=np.float32)}
     }
 
+    # Rolling window of recent validation SSIMs (for convergence checks)
     n_tail = 5
+    ssim_tail = np.zeros(n_tail + 1)
     learning_rate = training['learning_rate']
     model_output_dirname = os.path.join(directory, dcn.model_code, dcn.scoped_name)
     
@@ -163,6 +229,16 @@ def train_dcn(tf_ops, training, data, directory='./data/models/dcn/playground/',
     # Create a summary writer and create the necessary directories
     sw = dcn.get_summary_writer(model_output_dirname)
 
+    # Set-up the input pipeline with data augmentation (if enabled, batches are staged on the device ahead of the
+    # training steps, otherwise they are fetched and fed explicitly)
+    with dcn.graph.as_default():
+        next_batch = training_batches(data, training, n_batches).make_one_shot_iterator().get_next()
+        if dcn.staged_input:
+            dcn.stage_input(next_batch)
+
+        # Fraction of NaN values in each model parameter (used for diagnostics in case of NaN loss)
+        nan_checks = {var.name: tf.reduce_mean(tf.cast(tf.is_nan(var), tf.float32)) for var in dcn.parameters}
+
     with tqdm.tqdm(total=training['n_epochs'], ncols=160, desc=dcn.model_code.split('/')[-1]) as pbar:
 
         for epoch in range(0, training['n_epochs']):
@@ -175,103 +251,74 @@ def train_dcn(tf_ops, training, data, directory='./data/models/dcn/playground/',
             # Iterate through batches of the training data
             for batch_id in range(n_batches):
 
-                # Pick random patch size - will be resized later for augmentation
-                current_patch = np.random.choice(np.arange(training['patch_size'], 2 * training['patch_size']),
-                                                 1) if np.random.uniform() < training['augmentation_probs'][
-                    'resize'] else training['patch_size']
-
-                # Sample next batch
-                batch_x = data.next_training_batch(batch_id, training['batch_size'], current_patch)
-
-                # If rescaling needed, apply
-                if training['patch_size'] != current_patch:
-                    batch_t = np.zeros((batch_x.shape[0], training['patch_size'], training['patch_size'], 3),
-                                       dtype=np.float32)
-                    for i in range(len(batch_x)):
-                        batch_t[i] = resize(batch_x[i], [training['patch_size'], training['patch_size']],
-                                            anti_aliasing=True)
-                    batch_x = batch_t
-
-                    # Data augmentation - random horizontal flip
-                if np.random.uniform() < training['augmentation_probs']['flip_h']: batch_x = batch_x[:, :, ::-1, :]
-                if np.random.uniform() < training['augmentation_probs']['flip_v']: batch_x = batch_x[:, ::-1, :, :]
-                if np.random.uniform() < training['augmentation_probs']['gamma']: batch_x = utils.batch_gamma(batch_x)
-
                 # Sample dropout
                 keep_prob = 1.0 if not training['sample_dropout'] else np.random.uniform(0.5, 1.0)
 
-                # Make a training step
+                # Make a training step (on the next batch from the input pipeline)
+                batch_x = None if dcn.staged_input else dcn.sess.run(next_batch)
                 values = dcn.training_step(batch_x, learning_rate, dropout_keep_prob=keep_prob)
 
                 # TODO temporary nan hook
                 if np.isnan(values['loss']):
                     print('NaN loss detected - dumping current variables')
                     codebook = dcn.get_codebook()
-                    # Get some extra stats
-                    if dcn.scale_latent:
-                        scaling = dcn.sess.run(
-                            dcn.graph.get_tensor_by_name('{}/encoder/latent_scaling:0'.format(dcn.scoped_name)))
-                    else:
-                        scaling = np.nan
+                    # Get some extra stats & check all variables for NaNs (all parameters in a single run)
+                    scaling = dcn.diagnostics(batch_x).get('scaling', np.nan)
+                    nan_stats = dcn.sess.run(nan_checks)
                     print('Scaling: {}'.format(scaling))
                     print('Codebook: {}'.format(codebook.tolist()))
-                    # Dump all variables to check which is nan
-                    for var in dcn.parameters:
-                        if np.any(np.isnan(dcn.sess.run(var))):
-                            nan_perc = np.mean(np.isnan(dcn.sess.run(var)))
-                            print('!! NaNs found in {} --> {}'.format(var.name, nan_perc))
+                    # Dump all variables which contain NaNs
+                    for var_name, nan_perc in nan_stats.items():
+                        if nan_perc > 0:
+                            print('!! NaNs found in {} --> {}'.format(var_name, nan_perc))
+                    sw.flush()
                     return None
 
                 for key, value in values.items():
-                    caches[key]['training'].append(value)
+                    caches[key]['training'][batch_id] = value
 
             # Record average values for the whole epoch
             for key in ['loss', 'ssim', 'entropy']:
-                perf[key]['training'].append(float(np.mean(caches[key]['training'])))
-
-            # Get some extra stats
-            if dcn.scale_latent:
-                scaling = dcn.sess.run(
-                    dcn.graph.get_tensor_by_name('{}/encoder/latent_scaling:0'.format(dcn.scoped_name)))
-            else:
-                scaling = np.nan
+                perf[key]['training'].append(float(caches[key]['training'].mean()))
 
-            codebook = dcn.get_codebook()
+            # Get some extra stats (latent scaling, batch / population stats for batch norm)
+            diagnostics = dcn.diagnostics(batch_x)
+            scaling = diagnostics.get('scaling', np.nan)
 
             # Iterate through batches of the validation data
             if epoch % training['validation_schedule'] == 0:
 
-                for batch_id in range(v_batches):
-                    batch_x = data.next_validation_batch(batch_id, training['batch_size'])
-                    batch_z = dcn.compress(batch_x, is_training=training['validation_is_training'])
-                    batch_y = dcn.decompress(batch_z)
+                # Get current version of the quantization codebook (shared by all summaries in this epoch)
+                codebook = dcn.get_codebook().astype(np.float32)
+
+                # Validation batches are loaded in a background thread while the previous batch is being evaluated
+                with ThreadPoolExecutor(max_workers=1) as executor:
+                    next_validation = executor.submit(data.next_validation_batch, 0, training['batch_size'])
+
+                    for batch_id in range(v_batches):
+                        batch_x = next_validation.result()
+                        if batch_id + 1 < v_batches:
+                            next_validation = executor.submit(data.next_validation_batch, batch_id + 1, training['batch_size'])
 
-                    # Compute loss
-                    loss_value = np.linalg.norm(batch_x - batch_y)
-                    caches['loss']['validation'].append(loss_value)
+                        # Compute loss, SSIM and entropy (keep the outputs of the last batch for visualization)
+                        values = dcn.evaluate(batch_x, is_training=training['validation_is_training'], with_outputs=batch_id == v_batches - 1)
 
-                    # Compute SSIM
-                    ssim_value = np.mean([ssim(batch_x[r], batch_y[r], multichannel=True, data_range=1.0) for r in range(len(batch_x))])
-                    caches['ssim']['validation'].append(ssim_value)
+                        for key in ['loss', 'ssim', 'entropy']:
+                            caches[key]['validation'][batch_id] = values[key]
 
-                    # Entropy
-                    entropy_value = utils.entropy(batch_z, codebook)
-                    caches['entropy']['validation'].append(entropy_value)
+                batch_y, batch_z = values['y'], values['z']
 
                 for key in ['loss', 'ssim', 'entropy']:
-                    perf[key]['validation'].append(float(np.mean(caches[key]['validation'])))
-
-                # Save current snapshot
-                indices = np.argsort(np.var(batch_x, axis=(1, 2, 3)))[::-1]
-                thumbs_pairs_all = np.concatenate((batch_x[indices[::2]], batch_y[indices[::2]]), axis=0)
-                thumbs_pairs_few = np.concatenate((batch_x[indices[:5]], batch_y[indices[:5]]), axis=0)
-                thumbs = (255 * plotting.thumbnails(thumbs_pairs_all, n_cols=training['batch_size'] // 2)).astype(np.uint8)
-                thumbs_few = (255 * plotting.thumbnails(thumbs_pairs_few, n_cols=5)).astype(np.uint8)
+                    perf[key]['validation'].append(float(caches[key]['validation'].mean()))
+
+                # Save current snapshot (selected images are converted to uint8 before tiling - 4x less data to copy)
+                indices = np.argsort(-batch_x.var(axis=(1, 2, 3)))
+                thumbs_pairs_all = np.concatenate([(255 * batch[indices[::2]]).astype(np.uint8) for batch in (batch_x, batch_y)], axis=0)
+                thumbs_pairs_few = np.concatenate([(255 * batch[indices[:5]]).astype(np.uint8) for batch in (batch_x, batch_y)], axis=0)
+                thumbs = plotting.thumbnails(thumbs_pairs_all, n_cols=training['batch_size'] // 2)
+                thumbs_few = plotting.thumbnails(thumbs_pairs_few, n_cols=5)
                 imageio.imsave(os.path.join(model_output_dirname, 'thumbnails-{:05d}.png'.format(epoch)), thumbs)
 
-                # Sample latent space
-                batch_z = dcn.compress(batch_x)
-
                 # Save summaries to TB
                 summary = tf.Summary()
                 summary.value.add(tag='loss/validation', simple_value=perf['loss']['validation'][-1])
@@ -281,32 +328,37 @@ def train_dcn(tf_ops, training, data, directory='./data/models/dcn/playground/',
                 summary.value.add(tag='entropy/training', simple_value=perf['entropy']['training'][-1])
                 summary.value.add(tag='scaling', simple_value=scaling)
                 summary.value.add(tag='images/reconstructed',
-                                  image=summaries.log_image(rescale(thumbs_few, 1.0, anti_aliasing=True)))
+                                  image=summaries.log_image(thumbs_few))
                 summary.value.add(tag='histograms/latent', histo=summaries.log_histogram(batch_z))
                 summary.value.add(tag='histograms/latent_approx',
-                                  image=summaries.log_plot(visualize_distribution(dcn, data)))
+                                  image=summaries.log_plot(visualize_distribution(dcn, data, codebook=codebook)))
 
                 if dcn.train_codebook:
                     summary.value.add(tag='codebook/min', simple_value=codebook.min())
                     summary.value.add(tag='codebook/max', simple_value=codebook.max())
                     summary.value.add(tag='codebook/mean', simple_value=codebook.mean())
-                    summary.value.add(tag='codebook/diff_variance',
-                                      simple_value=np.var(np.convolve(codebook, [-1, 1], mode='valid')))
-                    summary.value.add(tag='codebook/centroids', image=summaries.log_plot(visualize_codebook(dcn)))
+                    summary.value.add(tag='codebook/diff_variance', simple_value=float(np.diff(codebook).var()))
+                    summary.value.add(tag='codebook/centroids', image=summaries.log_plot(visualize_codebook(dcn, codebook)))
 
                 sw.add_summary(summary, epoch)
-                sw.flush()
+
+                # The writer buffers events in the background - force writing to disk only occasionally
+                if epoch % (10 * training['validation_schedule']) == 0:
+                    sw.flush()
 
                 # Save stats to a JSON log
-                save_progress(dcn, data, training, model_output_dirname)
+                save_progress(dcn, data, training, model_output_dirname, codebook)
 
                 # Save current checkpoint
                 dcn.save_model(model_output_dirname, epoch)
 
                 # Check for convergence or model deterioration
-                if len(perf['ssim']['validation']) > 5:
-                    current = np.mean(perf['ssim']['validation'][-n_tail:])
-                    previous = np.mean(perf['ssim']['validation'][-(n_tail + 1):-1])
+                ssim_tail[:-1] = ssim_tail[1:]
+                ssim_tail[-1] = perf['ssim']['validation'][-1]
+
+                if len(perf['ssim']['validation']) > n_tail:
+                    current = ssim_tail[1:].mean()
+                    previous = ssim_tail[:-1].mean()
                     perf_change = abs((current - previous) / previous)
 
                     if perf_change < training['convergence_threshold']:
@@ -330,11 +382,10 @@ def train_dcn(tf_ops, training, data, directory='./data/models/dcn/playground/',
 
             if dcn.use_batchnorm:
                 # Get current batch / population stats
-                prebn = dcn.sess.run(dcn.pre_bn, feed_dict={dcn.x: batch_x})
-                bM = np.mean(prebn, axis=(0, 1, 2))
-                bV = np.var(prebn, axis=(0, 1, 2))
-                pM = dcn.sess.run(dcn.graph.get_tensor_by_name('{}/encoder/bn_0/moving_mean:0'.format(dcn.scoped_name)))
-                pV = dcn.sess.run(dcn.graph.get_tensor_by_name('{}/encoder/bn_0/moving_variance:0'.format(dcn.scoped_name)))
+                bM = np.mean(diagnostics['pre_bn'], axis=(0, 1, 2))
+                bV = np.var(diagnostics['pre_bn'], axis=(0, 1, 2))
+                pM = diagnostics['moving_mean']
+                pV = diagnostics['moving_variance']
 
                 # Append summary
                 progress_dict['MVp'] = '{:.2f}/{:.2f}'.format(np.mean(pM), np.mean(pV))
@@ -343,3 +394,5 @@ def train_dcn(tf_ops, training, data, directory='./data/models/dcn/playground/',
             # Update progress bar
             pbar.set_postfix(progress_dict)
             pbar.update(1)
+
+    sw.flush()